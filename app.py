@@ -1,9 +1,13 @@
 import os
+import itertools
+import threading
+import time
+import pandas as pd
 import streamlit as st
 import google.generativeai as genai
 from sqlalchemy import create_engine, text
-from utilities import text2sql, get_db_schema
-from constants import DB_PATH
+from utilities import text2sql, execute_query, get_cached_db_schema, prefetch_db_schema, clear_schema_cache, clear_query_cache
+from constants import DB_PATH, MAX_ROWS
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -44,34 +48,78 @@ st.markdown("<div class='sub-header'>Chat naturally with your SQL database and g
 # ---------------------- SESSION INITIALIZATION ----------------------
 defaults = {
     "engine": None,
+    "conn": None,
+    "conn_opened_at": 0.0,
+    "conn_used_at": 0.0,
+    "prefetched_engine": None,
     "connected_db": "Default SQLite",
     "question_history": [],
     "show_schema": False,
     "show_history": False,
     "last_sql_query": None,
-    "last_result": None,
+    "last_result_id": None,
+    "row_limit": MAX_ROWS,
+    "token_stats": [],
 }
 for k, v in defaults.items():
     st.session_state.setdefault(k, v)
 
+# Held session connections are reopened at the MySQL engine's pool_recycle age and pinged after idling
+CONN_MAX_AGE = 1800
+CONN_PING_AFTER = 60
+
+# ---------------------- RESULT STORE ----------------------
+RESULT_STORE_SIZE = 100
+
+@st.cache_resource
+def result_store():
+    """Process-wide store for query results, so large DataFrames stay out of session state."""
+    return {"ids": itertools.count(1), "results": {}, "lock": threading.Lock()}
+
+def set_last_result(result):
+    """Store result and keep only its id in session state, replacing this session's previous result."""
+    store = result_store()
+    with store["lock"]:
+        store["results"].pop(st.session_state.last_result_id, None)
+        if result is None:
+            st.session_state.last_result_id = None
+            return
+        result_id = next(store["ids"])
+        store["results"][result_id] = result
+        # Sessions that ended never clean up after themselves; drop the oldest results instead
+        while len(store["results"]) > RESULT_STORE_SIZE:
+            del store["results"][next(iter(store["results"]))]
+    st.session_state.last_result_id = result_id
+
+def get_last_result():
+    return result_store()["results"].get(st.session_state.last_result_id)
+
 # ---------------------- DATABASE CONNECTION HELPER ----------------------
+@st.cache_resource(show_spinner=False)
 def get_database(db_type, db_path=None, mysql_host=None, mysql_user=None, mysql_password=None, mysql_db=None, mysql_port=3306):
-    """Return SQLAlchemy engine for SQLite or MySQL."""
-    try:
-        if db_type == "sqlite":
-            if not db_path:
-                raise ValueError("SQLite DB path missing.")
-            return create_engine(f"sqlite:///{db_path}")
+    """
+    Return SQLAlchemy engine for SQLite or MySQL, cached per connection parameters so reruns reuse one pool.
+    Raises on invalid details (exceptions are not cached, so a failed connect can be retried).
+    """
+    if db_type == "sqlite":
+        if not db_path:
+            raise ValueError("SQLite DB path missing.")
+        engine = create_engine(f"sqlite:///{db_path}")
+
+    elif db_type == "mysql":
+        if not all([mysql_host, mysql_user, mysql_password, mysql_db]):
+            raise ValueError("Missing MySQL details.")
+        url = f"mysql+mysqlconnector://{mysql_user}:{mysql_password}@{mysql_host}:{mysql_port}/{mysql_db}"
+        # The cached engine outlives idle connections, so ping on checkout and recycle before server timeouts
+        engine = create_engine(url, pool_pre_ping=True, pool_recycle=1800)
 
-        elif db_type == "mysql":
-            if not all([mysql_host, mysql_user, mysql_password, mysql_db]):
-                raise ValueError("Missing MySQL details.")
-            url = f"mysql+mysqlconnector://{mysql_user}:{mysql_password}@{mysql_host}:{mysql_port}/{mysql_db}"
-            return create_engine(url)
+    else:
+        raise ValueError(f"Unsupported database type: {db_type}")
 
-    except Exception as e:
-        st.error(f"❌ Database connection failed: {e}")
-        return None
+    # Tag the engine once; utilities read these instead of re-deriving them from engine.dialect
+    engine._chatdb_dialect = db_type
+    engine._chatdb_db_type = "MySQL" if db_type == "mysql" else "SQLite"
+    return engine
 
 # ---------------------- SIDEBAR CONFIG ----------------------
 st.sidebar.header("⚙️ Configuration")
@@ -101,9 +149,6 @@ if mode == "Connect MySQL Database":
                 mysql_port=int(mysql_port),
             )
 
-            if engine is None:
-                raise Exception("Engine creation failed (check credentials or driver).")
-
             with engine.connect() as conn:
                 conn.execute(text("SELECT 1"))
 
@@ -129,27 +174,77 @@ if mode == "Connect MySQL Database":
 
 # ---- SQLite Default ----
 else:
-    if st.session_state.engine is None or st.session_state.connected_db != "Default SQLite":
+    try:
         engine = get_database("sqlite", db_path=DB_PATH)
-        if engine:
+        if st.session_state.engine is not engine or st.session_state.connected_db != "Default SQLite":
             st.session_state.engine = engine
             st.session_state.connected_db = "Default SQLite"
             st.sidebar.success("✅ Using default demo SQLite database.")
+    except Exception as e:
+        st.error(f"❌ Database connection failed: {e}")
 
 # Stop if nothing connected
 if not st.session_state.engine:
     st.error("⚠️ No database connection found. Please connect to continue.")
     st.stop()
 
+def session_connection():
+    """
+    Return this session's Connection to the current engine, so queries skip the pool checkout.
+    A held connection bypasses pool_pre_ping/pool_recycle, so it is reopened after an engine switch,
+    when closed or invalidated, or past CONN_MAX_AGE, and pinged before reuse once idle for CONN_PING_AFTER.
+    If no connection can be opened, the engine is returned instead, so the query reports the failure
+    through the usual error message rather than a traceback.
+    """
+    conn = st.session_state.conn
+    engine = st.session_state.engine
+    now = time.monotonic()
+    reopen = (
+        conn is None or conn.engine is not engine or conn.closed or conn.invalidated
+        or now - st.session_state.conn_opened_at > CONN_MAX_AGE
+    )
+    if not reopen and now - st.session_state.conn_used_at > CONN_PING_AFTER:
+        try:
+            conn.exec_driver_sql("SELECT 1")
+            conn.rollback()
+        except Exception:
+            reopen = True
+
+    if reopen:
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        st.session_state.conn = None
+        try:
+            conn = engine.connect()
+        except Exception:
+            return engine
+        st.session_state.conn = conn
+        st.session_state.conn_opened_at = now
+    st.session_state.conn_used_at = now
+    return conn
+
+# Load the schema in the background while the user is still typing their first question
+if st.session_state.prefetched_engine is not st.session_state.engine:
+    prefetch_db_schema(st.session_state.engine)
+    st.session_state.prefetched_engine = st.session_state.engine
+
 # ---------------------- GEMINI API ----------------------
 # api_key = st.sidebar.text_input("Enter your Google Gemini API Key:", type="password")
 # if not api_key:
 #     st.warning("🔑 Please provide your Google API key to continue.")
 #     st.stop()
 
-try:
+@st.cache_resource(show_spinner=False)
+def make_genai_client(api_key):
+    """Configure Gemini and return the model client, built once per API key."""
     genai.configure(api_key=api_key)
-    genai_client = genai.GenerativeModel(model_name="gemini-2.5-flash")
+    return genai.GenerativeModel(model_name="gemini-2.5-flash")
+
+try:
+    genai_client = make_genai_client(api_key)
 except Exception as e:
     st.error(f"❌ API configuration failed: {e}")
     st.stop()
@@ -171,17 +266,31 @@ if st.button("Execute"):
     if not st.session_state.question_history or query != st.session_state.question_history[-1]:
         st.session_state.question_history.append(query)
 
-    sql_query, result = text2sql(genai_client, query, st.session_state.engine)
+    sql_query, result = text2sql(genai_client, query, session_connection())
     st.session_state.last_sql_query = sql_query
-    st.session_state.last_result = result
+    set_last_result(result)
+    st.session_state.row_limit = MAX_ROWS
 
 # ---------------------- DISPLAY ----------------------
-if st.session_state.last_sql_query or st.session_state.last_result:
+def load_more_rows():
+    st.session_state.row_limit += MAX_ROWS
+    set_last_result(execute_query(
+        st.session_state.last_sql_query, session_connection(), max_rows=st.session_state.row_limit
+    ))
+
+last_result = get_last_result()
+if st.session_state.last_sql_query or last_result is not None:
     with st.expander("🧠 Generated SQL Query", expanded=True):
         st.code(st.session_state.last_sql_query or "No SQL generated", language="sql")
     with st.expander("📊 Query Result", expanded=True):
-        if st.session_state.last_result is not None:
-            st.write(st.session_state.last_result)
+        result = last_result
+        row_limit = st.session_state.row_limit
+        if isinstance(result, pd.DataFrame) and len(result) > row_limit:
+            st.info(f"ℹ️ Showing the first {row_limit} rows; the query returned more.")
+            st.write(result.head(row_limit))
+            st.button("⬇️ Load more rows", on_click=load_more_rows)
+        elif result is not None:
+            st.write(result)
         else:
             st.info("No results to display.")
 else:
@@ -197,7 +306,7 @@ st.sidebar.button(toggle_label, on_click=toggle_schema)
 if st.session_state.show_schema:
     with st.expander("📘 Database Schema", expanded=True):
         with st.spinner("Fetching schema..."):
-            schema_text = get_db_schema(st.session_state.engine)
+            schema_text = get_cached_db_schema(session_connection())
             st.markdown(schema_text)
             st.download_button(
                 "⬇️ Download Schema",
@@ -213,9 +322,14 @@ def toggle_history():
 def reset_conversation():
     st.session_state.question_history.clear()
     st.session_state.last_sql_query = None
-    st.session_state.last_result = None
+    set_last_result(None)
+    clear_query_cache()
     st.sidebar.success("✅ Cleared history and last output!")
 
+def refresh_schema():
+    clear_schema_cache()
+    st.sidebar.success("✅ Schema cache cleared!")
+
 st.sidebar.markdown("---")
 history_label = "📜 Show History" if not st.session_state.show_history else "🙈 Hide History"
 st.sidebar.button(history_label, on_click=toggle_history)
@@ -227,5 +341,13 @@ if st.session_state.show_history:
             st.sidebar.markdown(f"**{i}.** {question}")
     else:
         st.sidebar.info("No questions asked yet.")
+    if st.session_state.token_stats:
+        cached_tokens = sum(cached for cached, _ in st.session_state.token_stats)
+        prompt_tokens = sum(total for _, total in st.session_state.token_stats)
+        st.sidebar.markdown(
+            f"**⚡ Prompt cache hit rate:** {cached_tokens / prompt_tokens:.0%} "
+            f"({cached_tokens:,} of {prompt_tokens:,} input tokens cached)"
+        )
     st.sidebar.markdown("---")
     st.sidebar.button("♻️ Reset Conversation", on_click=reset_conversation)
+    st.sidebar.button("🔄 Refresh Schema", on_click=refresh_schema)
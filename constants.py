@@ -29,4 +29,7 @@ Schema:
 {schemas}
 """
 
-DB_PATH = "data/ecommerce_with_employees.db"
\ No newline at end of file
+DB_PATH = "data/ecommerce_with_employees.db"
+
+# Rows shown per query result; "Load more" raises the cap in steps of this size
+MAX_ROWS = 1000
@@ -1,156 +1,570 @@
-import json
+import contextlib
+import datetime
+import functools
+import hashlib
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import pandas as pd
 import sqlite3
-from constants import prompt
+import streamlit as st
+import google.generativeai as genai
+from google.generativeai import caching
+from constants import prompt, MAX_ROWS
 from sqlalchemy import inspect, text
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Connection, Engine
 
-def get_db_schema(engine):
+# Explicit Gemini context caches, one per database URL: url -> (prefix digest, cached model or None, CachedContent or None, expiry)
+_CACHE_REGISTRY = {}
+_CACHE_LOCKS = {}
+_CACHE_LOCKS_GUARD = threading.Lock()
+_CACHE_TTL = datetime.timedelta(minutes=10)
+# Background workers that warm the schema cache off the script thread
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chatdb-prefetch")
+# Markdown code fences (optionally tagged json/sql) the model sometimes wraps its answer in
+_FENCE_RE = re.compile(r"```(?:json|sql)?\n?|```")
+# Classify a statement by its leading verb in one match: m.lastgroup is "read" or "write" (no match: not SQL)
+_CLASSIFY = re.compile(
+    r"^\s*(?P<read>SELECT|WITH|SHOW|EXPLAIN|DESCRIBE)\b"
+    r"|^\s*(?P<write>INSERT|UPDATE|DELETE|DROP|ALTER|TRUNCATE|CREATE)\b",
+    re.IGNORECASE,
+)
+# Write verbs that WITH (a CTE) or EXPLAIN can wrap, e.g. "WITH x AS (...) DELETE ..." or "EXPLAIN ANALYZE DELETE ...";
+# a verb followed by "(" is a function call such as REPLACE(name, 'a', 'b'), not a statement
+_WRITE_VERB_RE = re.compile(r"\b(INSERT|UPDATE|DELETE|REPLACE|DROP|ALTER|TRUNCATE|CREATE)\b(?!\s*\()", re.IGNORECASE)
+# Cheap check for a user/model supplied row limit before we add our own
+_LIMIT_RE = re.compile(r"\bLIMIT\s+\d+", re.IGNORECASE)
+# Display names for dialects in the prompt; others use the dialect name as is
+_DB_TYPES = {"mysql": "MySQL", "sqlite": "SQLite"}
+# Rows pulled from the cursor per round when building result DataFrames
+FETCH_CHUNK_SIZE = 10_000
+
+
+def _dialect_of(connectable):
     """
-    Given a SQLAlchemy Engine, return a readable schema string containing CREATE statements for each table.
-    Works for both SQLite and MySQL engines.
+    Return the dialect tag get_database() set on the engine, deriving it for engines created elsewhere.
     """
-    try:
-        if not isinstance(engine, Engine):
-            return "❌ Invalid engine passed to get_db_schema()"
+    engine = connectable.engine
+    return getattr(engine, "_chatdb_dialect", None) or engine.dialect.name.lower()
 
-        inspector = inspect(engine)
-        tables = inspector.get_table_names()
 
-        if not tables:
-            return "⚠️ No tables found in the connected database."
+@contextlib.contextmanager
+def _checkout(connectable):
+    """
+    Yield a Connection for connectable (an Engine or a caller-held Connection).
+    An Engine lends a pooled connection for the block. A held Connection is reused as is and its
+    transaction is ended afterwards, so it keeps no locks and the next use sees fresh data.
+    """
+    if isinstance(connectable, Engine):
+        with connectable.connect() as conn:
+            yield conn
+    else:
+        try:
+            yield connectable
+        finally:
+            connectable.rollback()
+
+
+def get_db_schema(connectable):
+    """
+    Given a SQLAlchemy Engine or Connection, return a readable schema string containing CREATE statements for each table.
+    Works for both SQLite and MySQL engines; each fetches every table's DDL in a single query.
+    """
+    try:
+        if not isinstance(connectable, (Engine, Connection)):
+            return "❌ Invalid engine passed to get_db_schema()"
 
-        schema = ""
-        dialect = engine.dialect.name.lower()
+        dialect = _dialect_of(connectable)
 
-        with engine.connect() as conn:
+        with _checkout(connectable) as conn:
             if dialect == "mysql":
-                # Use SHOW CREATE TABLE for MySQL to get full DDL
-                for table in tables:
-                    res = conn.execute(text(f"SHOW CREATE TABLE `{table}`;"))
-                    row = res.fetchone()
-                    # row structure: (table_name, create_stmt)
-                    create_stmt = row[1] if row is not None else "/* could not fetch */"
-                    schema += f"**{table} table:**\n```sql\n{create_stmt}\n```\n\n"
+                # Rebuild CREATE statements from information_schema in one roundtrip
+                table_ddl = _mysql_table_ddl(conn)
             elif dialect == "sqlite":
-                # Use sqlite_master for SQLite
-                for table in tables:
-                    res = conn.execute(text(f"SELECT sql FROM sqlite_master WHERE name = :t;"), {"t": table})
-                    row = res.fetchone()
-                    create_stmt = row[0] if row and row[0] else f"/* CREATE statement not found for {table} */"
-                    schema += f"**{table} table:**\n```sql\n{create_stmt}\n```\n\n"
+                # sqlite_master already stores the CREATE statement of every table
+                res = conn.execute(text(
+                    "SELECT name, sql FROM sqlite_master "
+                    "WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name;"
+                ))
+                table_ddl = [
+                    (table, create_stmt or f"/* CREATE statement not found for {table} */")
+                    for table, create_stmt in res
+                ]
             else:
                 # Generic fallback: attempt to describe columns
-                for table in tables:
+                inspector = inspect(conn)
+                table_ddl = []
+                for table in inspector.get_table_names():
                     cols = inspector.get_columns(table)
                     col_text = ", ".join([f"{c['name']} {str(c['type'])}" for c in cols])
-                    create_stmt = f"CREATE TABLE {table} ({col_text});"
-                    schema += f"**{table} table:**\n```sql\n{create_stmt}\n```\n\n"
-        return schema
+                    table_ddl.append((table, f"CREATE TABLE {table} ({col_text});"))
+
+        if not table_ddl:
+            return "⚠️ No tables found in the connected database."
+
+        return "".join(f"**{table} table:**\n```sql\n{create_stmt}\n```\n\n" for table, create_stmt in table_ddl)
 
     except Exception as e:
         return f"❌ Error loading DB schema: {e}"
 
 
+def _mysql_table_ddl(conn):
+    """
+    Return [(table, create_stmt)] for every base table of the current MySQL database.
+    Statements list columns, NOT NULL, primary and foreign keys, which is what the model needs to write queries.
+    """
+    res = conn.execute(text("""
+        SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_KEY,
+               k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME
+        FROM information_schema.COLUMNS c
+        JOIN information_schema.TABLES t
+          ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME AND t.TABLE_TYPE = 'BASE TABLE'
+        LEFT JOIN information_schema.KEY_COLUMN_USAGE k
+          ON k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME
+         AND k.COLUMN_NAME = c.COLUMN_NAME AND k.REFERENCED_TABLE_NAME IS NOT NULL
+        WHERE c.TABLE_SCHEMA = DATABASE()
+        ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION;
+    """))
+
+    tables = {}
+    previous = None
+    for table, column, column_type, is_nullable, column_key, ref_table, ref_column in res:
+        columns, primary_key, foreign_keys = tables.setdefault(table, ([], [], []))
+        # a column with several foreign keys comes back once per key, on consecutive rows
+        if (table, column) != previous:
+            columns.append(f"`{column}` {column_type}" + (" NOT NULL" if is_nullable == "NO" else ""))
+            if column_key == "PRI":
+                primary_key.append(column)
+        previous = (table, column)
+        if ref_table:
+            foreign_keys.append(f"FOREIGN KEY (`{column}`) REFERENCES `{ref_table}` (`{ref_column}`)")
+
+    table_ddl = []
+    for table, (columns, primary_key, foreign_keys) in tables.items():
+        lines = list(columns)
+        if primary_key:
+            lines.append("PRIMARY KEY (" + ", ".join(f"`{c}`" for c in primary_key) + ")")
+        lines.extend(foreign_keys)
+        table_ddl.append((table, f"CREATE TABLE `{table}` (\n  " + ",\n  ".join(lines) + "\n);"))
+    return table_ddl
+
+
+class _UncachedSchema(Exception):
+    """
+    Carries a get_db_schema() error message out of _schema_for, so st.cache_data doesn't store it.
+    """
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _schema_for(engine_url, dialect, _connectable):
+    """
+    Cached get_db_schema(), keyed on the engine URL and dialect.
+    The engine/connection itself is unhashable, so Streamlit skips it via the leading underscore.
+    Errors raise _UncachedSchema so one transient failure isn't served to every session.
+    """
+    schema = get_db_schema(_connectable)
+    if schema.startswith("❌"):
+        raise _UncachedSchema(schema)
+    return schema
+
+
+def get_cached_db_schema(connectable):
+    """
+    Return the schema string for connectable (Engine or Connection), reusing the cached copy for up to 10 minutes.
+    """
+    try:
+        return _schema_for(str(connectable.engine.url), _dialect_of(connectable), connectable)
+    except _UncachedSchema as e:
+        return e.message
+
+
+def prefetch_db_schema(engine):
+    """
+    Start loading the schema for engine into the cache in the background and return the Future.
+    Takes an Engine, not a session's Connection: connections must not be shared between threads.
+    A get_cached_db_schema() call made meanwhile waits for this load instead of starting another.
+    """
+    return _PREFETCH_POOL.submit(get_cached_db_schema, engine)
+
+
+def clear_schema_cache():
+    """
+    Drop cached schemas so the next call re-reads them from the database.
+    """
+    _schema_for.clear()
+
+
+def _top_level(sql):
+    """
+    Return sql with quoted literals, comments and parenthesised parts blanked out, leaving the outer statement.
+    Quote marks and the outermost brackets are kept, so a function call still reads as "NAME(   )", and the
+    result is as long as sql so an index into one points at the same character in the other.
+    """
+    out = []
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            keep = ch == quote
+            if keep:
+                quote = None
+        elif ch in "'\"`":
+            quote = ch
+            keep = True
+        elif sql.startswith(("--", "/*"), i):
+            end = sql.find("\n", i) if ch == "-" else sql.find("*/", i + 2)
+            end = len(sql) if end == -1 else end + (1 if ch == "-" else 2)
+            out.append(" " * (end - i))
+            i = end
+            continue
+        elif ch == "(":
+            depth += 1
+            keep = depth == 1
+        elif ch == ")":
+            depth -= 1
+            keep = depth == 0
+        else:
+            keep = depth == 0
+        out.append(ch if keep else " ")
+        i += 1
+    return "".join(out)
+
+
+def _statement_kind(sql):
+    """
+    Return ("read" | "write", verb) for sql, or (None, None) if it doesn't start with a known verb.
+    A WITH or EXPLAIN statement counts as a write when its outer statement contains a write verb,
+    and anything stacked after a top-level ";" counts as a write whatever it is.
+    """
+    m = _CLASSIFY.match(sql)
+    if m is None:
+        return None, None
+    verb = m.group(m.lastgroup).upper()
+    top = _top_level(sql)
+    if ";" in top.rstrip().rstrip(";"):
+        return "write", "multi-statement"
+    if m.lastgroup == "read" and verb in ("WITH", "EXPLAIN"):
+        hidden = _WRITE_VERB_RE.search(top)
+        if hidden:
+            return "write", hidden.group(1).upper()
+    return m.lastgroup, verb
+
+
+def _strip_fences(answer):
+    """
+    Remove markdown code fences and surrounding whitespace; most answers have no backticks, so skip the regex then.
+    """
+    return _FENCE_RE.sub("", answer).strip() if "`" in answer else answer.strip()
+
+
+def _leading_answer(answer):
+    """
+    Return the complete JSON object or read-only SQL statement at the start of answer,
+    or None while it is still incomplete. Quoted strings and SQL comments are skipped,
+    so braces and semicolons inside them don't end the answer early.
+    """
+    is_json = answer.startswith("{")
+    if not is_json and _statement_kind(answer)[0] != "read":
+        return None
+    quotes = '"' if is_json else "'\"`"
+
+    depth = 0
+    quote = None
+    escaped = False
+    i = 0
+    while i < len(answer):
+        ch = answer[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == "\\" and is_json:
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch in quotes:
+            quote = ch
+        elif is_json and ch in "{}":
+            depth += 1 if ch == "{" else -1
+            if depth == 0:
+                return answer[:i + 1]
+        elif not is_json and answer.startswith(("--", "/*"), i):
+            # jump past the comment; one still open means the statement isn't complete yet
+            end = answer.find("\n", i) if ch == "-" else answer.find("*/", i + 2)
+            if end == -1:
+                return None
+            i = end + (1 if ch == "-" else 2)
+            continue
+        elif not is_json and ch == ";":
+            return answer[:i + 1]
+        i += 1
+    return None
+
+
+def _record_token_usage(usage):
+    """
+    Append (cached, prompt) input token counts of one Gemini call to st.session_state.token_stats.
+    """
+    if usage is None or not usage.prompt_token_count:
+        return
+    st.session_state.setdefault("token_stats", []).append(
+        (usage.cached_content_token_count, usage.prompt_token_count)
+    )
+
+
 def get_sql_query(genai_client, prompt_text, query):
     """
     Send prompt_text + user query to the LLM.
+    prompt_text is sent as its own leading part so it stays byte-identical across questions
+    (Gemini's implicit prompt caching only applies to a shared prefix). Pass None when
+    genai_client already carries the prompt in an explicit context cache.
     Accepts either a JSON response or plain SQL.
     Returns a dict with keys 'status' and 'response'.
     """
-    contents = f"{prompt_text}\n\nUser Question:\n{query}"
+    question = f"User Question:\n{query}"
+    parts = [prompt_text, question] if prompt_text else [question]
+    contents = [{"role": "user", "parts": parts}]
 
     try:
-        response = genai_client.generate_content(contents)
-        ai_text = response.text.strip()
+        # Stream the answer and stop reading once the first statement (or JSON object) is complete,
+        # instead of waiting for trailing tokens we would discard anyway
+        response = genai_client.generate_content(contents, stream=True)
+        buffer = ""
+        usage = None
+        for chunk in response:
+            usage = chunk.usage_metadata or usage
+            if not chunk.parts:
+                continue
+            buffer += chunk.text
+            answer = _leading_answer(_strip_fences(buffer))
+            if answer is not None:
+                buffer = answer
+                break
+        _record_token_usage(usage)
 
-        # strip codeblock wrappers and common prefixes
-        cleaned = ai_text
-        # remove triple backticks with optional language tags
-        cleaned = cleaned.replace("```json", "").replace("```sql", "").replace("```", "").strip()
+        cleaned = _strip_fences(buffer)
         # remove leading 'sql ' or 'SQL ' if model prepends it
-        if cleaned.lower().startswith("sql "):
+        if cleaned[:4].lower() == "sql ":
             cleaned = cleaned[4:].strip()
 
-        # Try parse JSON first
-        try:
-            parsed = json.loads(cleaned)
-            # Ensure it has status & response
-            if isinstance(parsed, dict) and ("status" in parsed and "response" in parsed):
-                return parsed
-            # If it's JSON but not the expected shape, treat as error message
-            return {"status": "error", "response": f"Model returned JSON but missing keys: {cleaned}"}
-        except json.JSONDecodeError:
-            # Not JSON — see if it looks like SQL
-            sql_candidate = cleaned
-            if not sql_candidate:
-                return {"status": "error", "response": "Model returned empty response."}
-
-            # Heuristic: starts with SQL verbs
-            sql_verbs = ("select", "show", "insert", "update", "delete", "create", "drop", "alter")
-            if any(sql_candidate.lower().lstrip().startswith(v) for v in sql_verbs):
-                return {"status": "success", "response": sql_candidate}
-            # Otherwise return error with the raw text
-            return {"status": "error", "response": f"Model returned unexpected format:\n{cleaned}"}
+        # Only JSON-shaped answers go through the parser; plain SQL (the common case) skips it
+        if cleaned.startswith("{"):
+            try:
+                parsed = orjson.loads(cleaned)
+                # Ensure it has status & response
+                if isinstance(parsed, dict) and ("status" in parsed and "response" in parsed):
+                    return parsed
+                # If it's JSON but not the expected shape, treat as error message
+                return {"status": "error", "response": f"Model returned JSON but missing keys: {cleaned}"}
+            except orjson.JSONDecodeError:
+                pass
+
+        # Not JSON — see if it looks like SQL
+        if not cleaned:
+            return {"status": "error", "response": "Model returned empty response."}
+
+        # Heuristic: starts with a SQL verb
+        if _CLASSIFY.match(cleaned):
+            return {"status": "success", "response": cleaned}
+        # Otherwise return error with the raw text
+        return {"status": "error", "response": f"Model returned unexpected format:\n{cleaned}"}
 
     except Exception as e:
         return {"status": "error", "response": f"AI communication error: {e}"}
 
 
-def execute_query(query, engine):
+def execute_query(query, connectable, read_only=True, max_rows=MAX_ROWS):
     """
-    Execute SQL query using the SQLAlchemy engine and return a DataFrame or an error string.
+    Execute SQL query using the SQLAlchemy Engine or Connection and return a DataFrame or an error string.
+    With read_only (the default), anything other than a read statement is refused before reaching the database.
+    At most max_rows + 1 rows are fetched (None for no cap), so callers can tell a truncated result
+    by len(df) > max_rows. SELECT/WITH queries without a LIMIT get one added so the database stops early too.
     """
     try:
-        if not isinstance(engine, Engine):
-            return f"❌ execute_query expected SQLAlchemy Engine, got {type(engine)}"
-
-        # Use text(query) so SQLAlchemy treats it properly
-        with engine.connect() as conn:
-            # pd.read_sql_query accepts SQLAlchemy connectable or connection
-            df = pd.read_sql_query(text(query), conn)
-            return df
+        if not isinstance(connectable, (Engine, Connection)):
+            return f"❌ execute_query expected SQLAlchemy Engine or Connection, got {type(connectable)}"
+
+        kind, verb = _statement_kind(query)
+        if read_only and kind != "read":
+            return f"❌ Refusing to run {verb or 'unrecognised'} SQL: the connection is read-only."
+
+        fetch_limit = None if max_rows is None else max_rows + 1
+        if fetch_limit is not None and kind == "read" and verb in ("SELECT", "WITH"):
+            top = _top_level(query)
+            if not _LIMIT_RE.search(top):
+                # appended rather than wrapped in a subquery: MySQL rejects derived tables with duplicate column names;
+                # cut after the last top-level code so a trailing comment or ";" can't swallow the LIMIT
+                query = f"{query[:len(top.rstrip().rstrip(';').rstrip())]} LIMIT {fetch_limit}"
+
+        # Build the DataFrame straight from the driver rows, skipping pandas' SQL adapter layer
+        with _checkout(connectable) as conn:
+            result = conn.execution_options(stream_results=True).execute(text(query))
+            columns = list(result.keys())
+            frames = []
+            fetched = 0
+            while fetch_limit is None or fetched < fetch_limit:
+                size = FETCH_CHUNK_SIZE if fetch_limit is None else min(FETCH_CHUNK_SIZE, fetch_limit - fetched)
+                rows = result.fetchmany(size)
+                if not rows:
+                    break
+                fetched += len(rows)
+                frames.append(pd.DataFrame.from_records(rows, columns=columns, coerce_float=True))
+
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
     except Exception as e:
         return f"❌ SQL Execution Error: {e}"
 
 
-def text2sql(genai_client, user_query, engine):
+@functools.lru_cache(maxsize=8)
+def build_prompt_prefix(db_type, db_schema):
     """
-    Top-level: get schema, produce prompt, ask LLM, run SQL, return (sql_string_or_none, result_or_error_msg).
-    engine must be a SQLAlchemy Engine.
+    Compose the contextual prompt: the base prompt with the schema filled into its {schemas} slot,
+    then the database type and output rules. Cached so repeated questions against the same schema
+    reuse the exact same string.
     """
-    if not user_query or len(user_query.strip()) < 3:
-        return None, "⚠️ Please enter a meaningful question."
+    # the base prompt contains literal JSON braces, so fill the slot with replace() rather than format()
+    return (
+        prompt.replace("{schemas}", db_schema.rstrip())
+        + f"\nConnected database type: {db_type}\n"
+        + f"Important: produce SQL compatible with {db_type}. Output either:\n"
+        + '- A JSON object: { "status": "success", "response": "<SQL query>" } or\n'
+        + "- Plain SQL (e.g. SELECT ...;). If plain SQL is returned, it will be treated as success.\n"
+        + "Do NOT include explanatory text alongside the SQL.\n"
+    )
 
-    if not isinstance(engine, Engine):
-        return None, "❌ Internal error: engine is not a SQLAlchemy Engine."
 
-    # Determine dialect and schema
-    dialect = engine.dialect.name.lower()
-    db_type = "MySQL" if dialect == "mysql" else "SQLite" if dialect == "sqlite" else dialect
-    db_schema = get_db_schema(engine)
+def _cache_lock(cache_key):
+    """
+    Return the lock serialising registry updates for cache_key across sessions.
+    """
+    with _CACHE_LOCKS_GUARD:
+        return _CACHE_LOCKS.setdefault(cache_key, threading.Lock())
 
-    # Compose detailed contextual prompt for the model (overrides constants prompt but uses it as base)
-    contextual_prompt = f"""
-        {prompt}
 
-        Connected database type: {db_type}
-        Here is the database schema (DDL):
-        {db_schema}
+def get_cached_model(genai_client, cache_key, prompt_prefix):
+    """
+    Return a GenerativeModel backed by an explicit Gemini context cache holding prompt_prefix, or None.
+    One cache is kept per cache_key (database URL) and replaced when the prefix changes or expires.
+    Gemini refuses to cache prompts below its minimum token count; that outcome is remembered
+    for the TTL so small schemas don't pay a failed create call on every question.
+    """
+    digest = hashlib.sha256(prompt_prefix.encode()).hexdigest()
+    # held across check, delete and create so concurrent sessions don't create duplicate (billed) caches
+    with _cache_lock(cache_key):
+        entry = _CACHE_REGISTRY.get(cache_key)
+        if entry is not None:
+            cached_digest, cached_model, cached_content, expires_at = entry
+            if cached_digest == digest and time.monotonic() < expires_at:
+                return cached_model
+            # schema changed: drop the obsolete server-side cache. An expired entry is left alone:
+            # it is refreshed 30s early, so in-flight requests may still be using it until it lapses.
+            if cached_digest != digest and cached_content is not None:
+                try:
+                    cached_content.delete()
+                except Exception:
+                    pass
+
+        # refresh slightly before the server-side TTL so a request never races the expiry
+        expires_at = time.monotonic() + _CACHE_TTL.total_seconds() - 30
+        try:
+            cached_content = caching.CachedContent.create(
+                model=genai_client.model_name,
+                contents=[prompt_prefix],
+                ttl=_CACHE_TTL,
+            )
+            cached_model = genai.GenerativeModel.from_cached_content(cached_content)
+        except Exception:
+            cached_content, cached_model = None, None
+
+        _CACHE_REGISTRY[cache_key] = (digest, cached_model, cached_content, expires_at)
+        return cached_model
 
-        Important: produce SQL compatible with {db_type}. Output either:
-        - A JSON object: {{ "status": "success", "response": "<SQL query>" }} or
-        - Plain SQL (e.g. SELECT ...;). If plain SQL is returned, it will be treated as success.
-        Do NOT include explanatory text alongside the SQL.
+
+class _UncachedAnswer(Exception):
+    """
+    Carries a failed text2sql answer out of _cached_answer, so st.cache_data doesn't store it.
     """
+    def __init__(self, answer):
+        super().__init__()
+        self.answer = answer
+
+
+def _answer(genai_client, user_query, connectable, db_schema):
+    """
+    Produce prompt, ask LLM, run SQL, return (sql_string_or_none, result_or_error_msg).
+    """
+    engine = connectable.engine
+    db_type = getattr(engine, "_chatdb_db_type", None) or _DB_TYPES.get(_dialect_of(engine), engine.dialect.name)
+
+    # Static for a given database, so the model sees the same prompt prefix on every question
+    contextual_prompt = build_prompt_prefix(db_type, db_schema)
 
-    output = get_sql_query(genai_client, contextual_prompt, user_query)
+    cached_model = get_cached_model(genai_client, str(connectable.engine.url), contextual_prompt)
+    if cached_model is not None:
+        output = get_sql_query(cached_model, None, user_query)
+    else:
+        output = get_sql_query(genai_client, contextual_prompt, user_query)
 
     if isinstance(output, dict) and output.get("status") == "success":
         sql_query = output.get("response")
-        result = execute_query(sql_query, engine)
+        result = execute_query(sql_query, connectable)
         return sql_query, result
     else:
         # output may be dict with error message
         msg = output.get("response") if isinstance(output, dict) else str(output)
         return None, msg
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_answer(normalized_query, engine_url, schema_hash, _genai_client, _user_query, _connectable, _db_schema):
+    """
+    Cached _answer(), keyed on the normalized question, database URL and schema hash.
+    Only answers with a result DataFrame are kept; errors raise _UncachedAnswer so they are retried next time.
+    """
+    sql_query, result = _answer(_genai_client, _user_query, _connectable, _db_schema)
+    if not isinstance(result, pd.DataFrame):
+        raise _UncachedAnswer((sql_query, result))
+    return sql_query, result
+
+
+def clear_query_cache():
+    """
+    Drop cached answers so repeated questions go back to the LLM and database.
+    """
+    _cached_answer.clear()
+
+
+def text2sql(genai_client, user_query, connectable):
+    """
+    Top-level: get schema, produce prompt, ask LLM, run SQL, return (sql_string_or_none, result_or_error_msg).
+    connectable must be a SQLAlchemy Engine or Connection. Repeated questions (ignoring case
+    and spacing) against an unchanged schema are answered from cache for up to an hour.
+    """
+    if not user_query or len(user_query.strip()) < 3:
+        return None, "⚠️ Please enter a meaningful question."
+
+    if not isinstance(connectable, (Engine, Connection)):
+        return None, "❌ Internal error: expected a SQLAlchemy Engine or Connection."
+
+    db_schema = get_cached_db_schema(connectable)
+    if db_schema.startswith("❌"):
+        return None, db_schema
+    schema_hash = hashlib.sha256(db_schema.encode()).hexdigest()
+    normalized_query = " ".join(user_query.lower().split())
+
+    try:
+        return _cached_answer(
+            normalized_query, str(connectable.engine.url), schema_hash, genai_client, user_query, connectable, db_schema
+        )
+    except _UncachedAnswer as e:
+        return e.answer